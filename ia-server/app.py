@@ -1,23 +1,69 @@
-from flask import Flask, request, jsonify
+import os
+import importlib.util
+from dotenv import load_dotenv
+
+# .env carregado antes de importar torch para valer também na configuração do alocador
+load_dotenv()
+
+# Alocador CUDA: pool do cudaMallocAsync (limite de liberação máximo) reaproveita
+# os buffers de KV por requisição do backend hf sem picos de cudaMalloc/cudaFree
+# (precisa ser definido antes de importar torch). O vLLM pré-aloca o próprio pool
+# de KV e captura seus CUDA graphs, assim como COMPILE_MODEL: ambos ficam com o
+# alocador nativo, já que o cudaMallocAsync não suporta o checkpoint de estado dos grafos.
+_BACKEND_DEFAULT = 'vllm' if importlib.util.find_spec('vllm') else 'hf'
+if (os.getenv('INFERENCE_BACKEND', _BACKEND_DEFAULT).lower() == 'hf'
+        and os.getenv('COMPILE_MODEL', 'false').lower() != 'true'):
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "backend:cudaMallocAsync")
+
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import torch
 import torch.cuda
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    AwqConfig,
+    StoppingCriteria,
+    StaticCache,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
 from peft import PeftModel
 import logging
-import os
-from dotenv import load_dotenv
 import time
 import psutil
 from typing import Dict, Any
 import traceback
+import threading
+import json
+import functools
+import copy
+import glob
+import hashlib
+import shutil
+import tempfile
+import queue
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+
+# FlashAttention-2 opcional (kernel de atenção fundido)
+try:
+    import flash_attn  # noqa: F401
+    FLASH_ATTN_AVAILABLE = True
+except ImportError:
+    FLASH_ATTN_AVAILABLE = False
+
+# Backend opcional de inferência (vLLM com PagedAttention + continuous batching)
+try:
+    from vllm import LLM, SamplingParams
+    from vllm.lora.request import LoRARequest
+    VLLM_AVAILABLE = True
+except ImportError:
+    VLLM_AVAILABLE = False
 
 # ============================================
 # CONFIGURAÇÃO INICIAL
 # ============================================
 
-load_dotenv()
-
 app = Flask(__name__)
 CORS(app)
 
@@ -27,16 +73,60 @@ logger = logging.getLogger(__name__)
 
 # Variáveis globais
 MODEL = None
+ENGINE = None
+LORA_REQUEST = None
 TOKENIZER = None
+PREFIX_IDS = []
+SUFFIX_IDS = []
+PREFIX_KV = None
+STATIC_CACHES = {}  # KV caches estáticos: lote unitário (streaming) e o último lote maior
 DEVICE = None
 MODEL_LOADED = False
+REQUEST_QUEUE = queue.Queue()
+GPU_LOCK = threading.Lock()  # Serializa gerações HF (batch worker e streaming)
+BATCH_WORKER = None
+CPU_PERCENT = 0.0
+CPU_MONITOR = None
 
 # Configurações
 BASE_MODEL = "unsloth/llama-3.1-8b-instruct-bnb-4bit"
 ADAPTER_PATH = os.getenv('ADAPTER_PATH', './adapters')
 MAX_TOKENS = int(os.getenv('MAX_TOKENS', 512))
-TEMPERATURE = float(os.getenv('TEMPERATURE', 0.7))
+TEMPERATURE = float(os.getenv('TEMPERATURE', 0.0))  # 0 = greedy (sem amostragem)
 TOP_P = float(os.getenv('TOP_P', 0.9))
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'vllm' if VLLM_AVAILABLE else 'hf').lower()  # 'hf' ou 'vllm'
+GPU_MEMORY_UTILIZATION = float(os.getenv('GPU_MEMORY_UTILIZATION', 0.9))
+KV_BLOCK_SIZE = int(os.getenv('KV_BLOCK_SIZE', 16))  # Tokens por bloco do KV cache paginado (vLLM)
+MAX_LORA_RANK = int(os.getenv('MAX_LORA_RANK', 16))
+QUANTIZED_MODEL_PATH = os.getenv('QUANTIZED_MODEL_PATH', '')  # Checkpoint AWQ com LoRA mesclado (quantize.py)
+MERGED_MODEL_PATH = os.getenv('MERGED_MODEL_PATH', './merged')  # Cache do modelo 4-bit com LoRA mesclado
+MERGED_FINGERPRINT_FILE = "adapter_fingerprint.txt"  # Versão dos adapters usada no merge em cache
+ATTN_IMPLEMENTATION = os.getenv('ATTN_IMPLEMENTATION', 'flash_attention_2' if FLASH_ATTN_AVAILABLE else 'sdpa')
+COMPILE_MODEL = os.getenv('COMPILE_MODEL', 'false').lower() == 'true'  # torch.compile + CUDA graphs (HF)
+STATIC_KV_CACHE = os.getenv('STATIC_KV_CACHE', str(COMPILE_MODEL)).lower() == 'true'  # KV cache pré-alocado e reutilizado (HF)
+MAX_PROMPT_TOKENS = int(os.getenv('MAX_PROMPT_TOKENS', 2048))  # Limite de tokens do prompt (com histórico)
+STATIC_CACHE_LEN = MAX_TOKENS + MAX_PROMPT_TOKENS  # Capacidade do KV cache estático (prompt + resposta)
+PREFIX_CACHE = os.getenv('PREFIX_CACHE', 'true').lower() == 'true'  # Reutilizar KV do prompt de sistema
+CPU_SAMPLE_INTERVAL_S = 2.0  # Intervalo de amostragem do uso de CPU (/stats)
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 8))  # Máximo de requisições por lote
+BATCH_WAIT_TIMEOUT_S = float(os.getenv('BATCH_WAIT_TIMEOUT_S', 0.002))  # Janela para agrupar requisições
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', BATCH_MAX_SIZE))  # Gerações simultâneas aceitas
+BUSY_TIMEOUT_S = float(os.getenv('BUSY_TIMEOUT_S', 5))  # Espera por vaga antes de responder 503
+GENERATION_TIMEOUT_S = float(os.getenv('GENERATION_TIMEOUT_S', 120))  # Espera máxima pelo resultado do lote
+
+# Limita gerações em andamento (evita disputa por memória GPU e OOM)
+GPU_SEMAPHORE = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+# Prompt de sistema fixo (tokenizado uma única vez em load_model)
+SYSTEM_PROMPT = "You are a helpful Python programming assistant. Write clear, correct, and well-commented code. Always provide working examples when appropriate."
+PROMPT_PREFIX = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{SYSTEM_PROMPT}<|eot_id|>"
+PROMPT_SUFFIX = "<|start_header_id|>assistant<|end_header_id|>\n\n"
+
+# Informações estáticas do dispositivo (consultadas uma única vez)
+CUDA_AVAILABLE = torch.cuda.is_available()
+GPU_NAME = torch.cuda.get_device_name(0) if CUDA_AVAILABLE else "N/A"
+TORCH_VERSION = torch.__version__
+GPU_MEMORY_TTL_S = 0.1  # Validade da leitura de memória GPU
 
 # ============================================
 # GERENCIAMENTO DE GPU
@@ -44,47 +134,191 @@ TOP_P = float(os.getenv('TOP_P', 0.9))
 
 def check_cuda():
     """Verifica status da GPU CUDA"""
-    if not torch.cuda.is_available():
+    if not CUDA_AVAILABLE:
         logger.error("❌ CUDA não está disponível!")
         return False
     
-    logger.info(f"✅ GPU disponível: {torch.cuda.get_device_name(0)}")
+    logger.info(f"✅ GPU disponível: {GPU_NAME}")
     logger.info(f"✅ CUDA Capability: {torch.cuda.get_device_capability(0)}")
     logger.info(f"✅ CUDA Version: {torch.version.cuda}")
     return True
 
+@functools.lru_cache(maxsize=1)
+def _read_gpu_memory(time_bucket: int):
+    """Lê uso de memória GPU; time_bucket agrupa chamadas na mesma janela de TTL"""
+    allocated = torch.cuda.memory_allocated() / 1e9
+    reserved = torch.cuda.memory_reserved() / 1e9
+    return {"allocated_gb": round(allocated, 2), "reserved_gb": round(reserved, 2)}
+
 def get_gpu_memory():
-    """Retorna uso de memória GPU em GB"""
-    if torch.cuda.is_available():
-        allocated = torch.cuda.memory_allocated() / 1e9
-        reserved = torch.cuda.memory_reserved() / 1e9
-        return {"allocated_gb": round(allocated, 2), "reserved_gb": round(reserved, 2)}
+    """Retorna uso de memória GPU em GB (cache de GPU_MEMORY_TTL_S)"""
+    if CUDA_AVAILABLE:
+        return _read_gpu_memory(int(time.monotonic() / GPU_MEMORY_TTL_S))
     return {"allocated_gb": 0, "reserved_gb": 0}
 
 def clear_gpu_memory():
     """Limpa memória GPU"""
-    if torch.cuda.is_available():
+    if CUDA_AVAILABLE:
+        # Com cudaMallocAsync, esvaziar o pool só força novas alocações na próxima requisição
+        if torch.cuda.get_allocator_backend() == "cudaMallocAsync":
+            logger.info("🧹 Pool cudaMallocAsync mantido (limpeza ignorada)")
+            return
         torch.cuda.empty_cache()
         logger.info("🧹 GPU cache limpo")
 
+# ============================================
+# MONITORAMENTO DE CPU
+# ============================================
+
+def _cpu_monitor():
+    """Atualiza o uso de CPU em segundo plano (sem bloquear requisições)"""
+    global CPU_PERCENT
+    
+    while True:
+        time.sleep(CPU_SAMPLE_INTERVAL_S)
+        CPU_PERCENT = psutil.cpu_percent(interval=None)
+
+def start_cpu_monitor():
+    """Inicia a amostragem de CPU (uma única vez)"""
+    global CPU_MONITOR
+    
+    if CPU_MONITOR is None:
+        # Primeira chamada só define a referência; retorna 0.0
+        psutil.cpu_percent(interval=None)
+        CPU_MONITOR = threading.Thread(target=_cpu_monitor, name="cpu-monitor", daemon=True)
+        CPU_MONITOR.start()
+
 # ============================================
 # CARREGAMENTO DO MODELO
 # ============================================
 
-def load_model():
-    """Carrega modelo Llama com adapters LoRA"""
-    global MODEL, TOKENIZER, DEVICE, MODEL_LOADED
+def use_quantized_checkpoint():
+    """Indica se existe checkpoint AWQ (LoRA já mesclado) para carregar"""
+    return bool(QUANTIZED_MODEL_PATH) and os.path.isdir(QUANTIZED_MODEL_PATH)
+
+def use_static_cache():
+    """Indica se a geração HF usa o KV cache estático (módulos AWQ fundidos mantêm cache próprio)"""
+    return STATIC_KV_CACHE and not use_quantized_checkpoint()
+
+def load_vllm_engine():
+    """Carrega o modelo no vLLM (PagedAttention + continuous batching) com LoRA"""
+    global ENGINE, LORA_REQUEST
+
+    if not VLLM_AVAILABLE:
+        raise RuntimeError("INFERENCE_BACKEND=vllm, mas o pacote vllm não está instalado")
+
+    if use_quantized_checkpoint():
+        # Pesos AWQ INT4 com LoRA mesclado: kernels fp16×int4, sem adapter em runtime
+        logger.info(f"📦 Carregando checkpoint AWQ de {QUANTIZED_MODEL_PATH} no vLLM...")
+        ENGINE = LLM(
+            model=QUANTIZED_MODEL_PATH,
+            quantization="awq",
+            gpu_memory_utilization=GPU_MEMORY_UTILIZATION,
+            block_size=KV_BLOCK_SIZE,
+            enable_prefix_caching=PREFIX_CACHE,
+            trust_remote_code=True
+        )
+        LORA_REQUEST = None
+        return
+
+    logger.info("📦 Carregando Llama-3.1-8B no vLLM...")
+    ENGINE = LLM(
+        model=BASE_MODEL,
+        quantization="bitsandbytes",
+        load_format="bitsandbytes",  # Exigido junto de quantization em versões 0.6.x do vLLM
+        enable_lora=True,
+        max_lora_rank=MAX_LORA_RANK,
+        gpu_memory_utilization=GPU_MEMORY_UTILIZATION,
+        block_size=KV_BLOCK_SIZE,
+        enable_prefix_caching=PREFIX_CACHE,
+        trust_remote_code=True
+    )
+
+    # Adapter LoRA aplicado por requisição pelo próprio vLLM
+    logger.info(f"🎯 Registrando LoRA adapters de {ADAPTER_PATH}...")
+    LORA_REQUEST = LoRARequest("python-adapter", 1, ADAPTER_PATH)
+
+def adapter_fingerprint():
+    """Identifica a versão dos adapters LoRA (caminho + nome/tamanho/mtime dos arquivos)"""
+    digest = hashlib.sha256(os.path.abspath(ADAPTER_PATH).encode())
+    for name in sorted(os.listdir(ADAPTER_PATH)):
+        path = os.path.join(ADAPTER_PATH, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+def merged_checkpoint_is_current(fingerprint: str):
+    """Indica se o modelo mesclado em cache foi gerado a partir dos adapters atuais"""
+    try:
+        with open(os.path.join(MERGED_MODEL_PATH, MERGED_FINGERPRINT_FILE)) as f:
+            return f.read().strip() == fingerprint
+    except OSError:
+        return False
+
+def save_merged_checkpoint(fingerprint: str):
+    """Salva o modelo mesclado em diretório temporário e o move atomicamente para MERGED_MODEL_PATH"""
+    parent = os.path.dirname(os.path.abspath(MERGED_MODEL_PATH))
+    os.makedirs(parent, exist_ok=True)
+    
+    # Restos de salvamentos interrompidos
+    for stale in glob.glob(os.path.join(parent, ".merged-*")):
+        shutil.rmtree(stale, ignore_errors=True)
     
+    tmp_dir = tempfile.mkdtemp(prefix=".merged-", dir=parent)
     try:
-        logger.info("🚀 Iniciando carregamento do modelo...")
-        start_time = time.time()
+        MODEL.save_pretrained(tmp_dir, safe_serialization=True)
+        # Fingerprint por último: só checkpoints completos são reutilizados
+        with open(os.path.join(tmp_dir, MERGED_FINGERPRINT_FILE), "w") as f:
+            f.write(fingerprint)
         
-        if not check_cuda():
-            logger.warning("⚠️  CUDA não disponível! Usando CPU (será muito mais lento)")
-            DEVICE = "cpu"
+        if os.path.isdir(MERGED_MODEL_PATH):
+            shutil.rmtree(MERGED_MODEL_PATH)
+        os.replace(tmp_dir, MERGED_MODEL_PATH)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+def load_hf_model():
+    """Carrega modelo 4-bit via Transformers com adapters LoRA mesclados"""
+    global MODEL
+
+    if use_quantized_checkpoint():
+        # Checkpoint AWQ INT4 (g128) com LoRA já mesclado; dispensa PEFT
+        logger.info(f"📦 Carregando checkpoint AWQ de {QUANTIZED_MODEL_PATH}...")
+        
+        # Módulos AWQ fundidos trazem atenção própria e não combinam com FlashAttention-2
+        if ATTN_IMPLEMENTATION == "flash_attention_2":
+            attn_kwargs = {"attn_implementation": ATTN_IMPLEMENTATION}
+            quantization_config = AwqConfig(bits=4, do_fuse=False)
         else:
-            DEVICE = "cuda"
+            attn_kwargs = {}
+            quantization_config = AwqConfig(bits=4, do_fuse=True, fuse_max_seq_len=STATIC_CACHE_LEN)
         
+        MODEL = AutoModelForCausalLM.from_pretrained(
+            QUANTIZED_MODEL_PATH,
+            device_map="auto",
+            torch_dtype=torch.float16,
+            quantization_config=quantization_config,
+            trust_remote_code=True,
+            **attn_kwargs
+        )
+        MODEL.eval()
+        return
+
+    fingerprint = adapter_fingerprint()
+    
+    if merged_checkpoint_is_current(fingerprint):
+        # Checkpoint 4-bit com LoRA já mesclado, salvo numa inicialização anterior
+        logger.info(f"📦 Carregando modelo mesclado de {MERGED_MODEL_PATH}...")
+        MODEL = AutoModelForCausalLM.from_pretrained(
+            MERGED_MODEL_PATH,
+            device_map="auto",
+            torch_dtype=torch.float16,
+            attn_implementation=ATTN_IMPLEMENTATION,
+            trust_remote_code=True
+        )
+    else:
         # Carregar modelo base com quantização 4-bit
         logger.info("📦 Carregando modelo base Llama-3.1-8B...")
         MODEL = AutoModelForCausalLM.from_pretrained(
@@ -92,23 +326,136 @@ def load_model():
             load_in_4bit=True,
             device_map="auto",
             torch_dtype=torch.float16,
+            attn_implementation=ATTN_IMPLEMENTATION,
             trust_remote_code=True
         )
+
+        # Carregar adapters LoRA e mesclar nos pesos base (uma GEMM por Linear)
+        logger.info(f"🎯 Mesclando LoRA adapters de {ADAPTER_PATH}...")
+        MODEL = PeftModel.from_pretrained(MODEL, ADAPTER_PATH)
+        MODEL = MODEL.merge_and_unload()
+
+        # Salvar para que as próximas inicializações pulem o merge
+        try:
+            save_merged_checkpoint(fingerprint)
+            logger.info(f"💾 Modelo mesclado salvo em {MERGED_MODEL_PATH}")
+        except Exception as e:
+            logger.warning(f"⚠️  Não foi possível salvar o modelo mesclado: {str(e)}")
+
+    # Modo inferência (gradientes desabilitados por torch.inference_mode na geração)
+    MODEL.eval()
+
+def configure_generation():
+    """Fixa tokens e decodificação padrão no generation_config (evita merge por chamada)"""
+    generation_config = MODEL.generation_config
+    generation_config.pad_token_id = TOKENIZER.pad_token_id
+    generation_config.eos_token_id = TOKENIZER.eos_token_id
+    
+    # Greedy por padrão; temperature/top_p só são enviados quando há amostragem
+    generation_config.do_sample = False
+    generation_config.num_beams = 1
+    generation_config.temperature = None
+    generation_config.top_p = None
+
+def compile_model():
+    """Compila o forward com CUDA graphs (requer STATIC_KV_CACHE); grafos capturados no warmup"""
+    if not COMPILE_MODEL:
+        return
+    
+    if not use_static_cache():
+        raise RuntimeError(
+            "COMPILE_MODEL=true requer STATIC_KV_CACHE=true e não é compatível com checkpoint AWQ "
+            "(um KV cache dinâmico força recompilações a cada passo de decodificação)"
+        )
+    
+    if DEVICE == "cuda" and torch.cuda.get_allocator_backend() == "cudaMallocAsync":
+        raise RuntimeError(
+            "COMPILE_MODEL=true não é compatível com PYTORCH_CUDA_ALLOC_CONF=backend:cudaMallocAsync "
+            "(CUDA graphs exigem o alocador nativo)"
+        )
+    
+    logger.info("🛠️  Compilando modelo (torch.compile, mode=reduce-overhead)...")
+    MODEL.forward = torch.compile(MODEL.forward, mode="reduce-overhead", fullgraph=False)
+
+def build_prefix_cache():
+    """Pré-computa o KV cache do prompt de sistema, reutilizado em toda geração"""
+    global PREFIX_KV
+    
+    # Módulos AWQ fundidos e o KV cache estático não aceitam um past_key_values dinâmico externo
+    if not PREFIX_CACHE or use_static_cache() or use_quantized_checkpoint():
+        PREFIX_KV = None
+        return
+    
+    logger.info(f"🧠 Pré-computando KV cache do prefixo ({len(PREFIX_IDS)} tokens)...")
+    with torch.inference_mode():
+        outputs = MODEL(torch.tensor([PREFIX_IDS], device=DEVICE), use_cache=True)
+    PREFIX_KV = outputs.past_key_values
+
+def warmup_model():
+    """Executa gerações de aquecimento (prompt curto e longo) pelo mesmo caminho das requisições"""
+    logger.info("🔥 Aquecendo modelo (kernels, handles cuBLAS, CUDA graphs)...")
+    warmup_start = time.time()
+    generate_fn = _generate_vllm_batch if INFERENCE_BACKEND == "vllm" else _generate_hf_batch
+    
+    # Formas curta e longa (~MAX_TOKENS de prompt) para cachear kernels específicos de shape
+    short_ids = build_input_ids(prompt="hello")
+    long_ids = build_input_ids(prompt=" ".join(["hello"] * min(MAX_TOKENS, MAX_PROMPT_TOKENS // 2)))
+    
+    # Lote unitário (streaming/requisição isolada) e lote cheio, os tamanhos que o worker
+    # produz com cache estático (lotes intermediários são completados até BATCH_MAX_SIZE)
+    for batch_size in sorted({1, BATCH_MAX_SIZE}):
+        for input_ids in (short_ids, long_ids):
+            generate_fn([(input_ids, 8, 0.0, Future()) for _ in range(batch_size)])
+    
+    logger.info(f"✅ Aquecimento concluído em {time.time() - warmup_start:.2f}s")
+
+def load_model():
+    """Carrega modelo Llama com adapters LoRA no backend configurado"""
+    global TOKENIZER, PREFIX_IDS, SUFFIX_IDS, DEVICE, MODEL_LOADED
+    
+    try:
+        logger.info("🚀 Iniciando carregamento do modelo...")
+        start_time = time.time()
+        
+        if not check_cuda():
+            logger.warning("⚠️  CUDA não disponível! Usando CPU (será muito mais lento)")
+            DEVICE = "cpu"
+        else:
+            DEVICE = "cuda"
+            # Limita o pool do alocador (o vLLM controla a própria reserva)
+            if INFERENCE_BACKEND != "vllm":
+                torch.cuda.set_per_process_memory_fraction(GPU_MEMORY_UTILIZATION)
+            
+            # Preferir o kernel flash no SDPA (math fica apenas como fallback)
+            torch.backends.cuda.enable_flash_sdp(True)
+            torch.backends.cuda.enable_mem_efficient_sdp(True)
+            logger.info(f"✅ Atenção: {ATTN_IMPLEMENTATION} (SDPA flash: {torch.backends.cuda.flash_sdp_enabled()})")
+        
+        # Carregar modelo no backend escolhido
+        logger.info(f"⚙️  Backend de inferência: {INFERENCE_BACKEND}")
+        if INFERENCE_BACKEND == "vllm":
+            load_vllm_engine()
+        else:
+            load_hf_model()
         
         # Carregar tokenizer
         logger.info("🔤 Carregando tokenizer...")
         TOKENIZER = AutoTokenizer.from_pretrained(BASE_MODEL, trust_remote_code=True)
+        if TOKENIZER.pad_token is None:
+            TOKENIZER.pad_token = TOKENIZER.eos_token
+        TOKENIZER.padding_side = "left"
         
-        # Carregar adapters LoRA
-        logger.info(f"🎯 Carregando LoRA adapters de {ADAPTER_PATH}...")
-        MODEL = PeftModel.from_pretrained(MODEL, ADAPTER_PATH)
+        # Pré-tokenizar o prefixo (system) e o sufixo (header do assistente)
+        PREFIX_IDS = TOKENIZER.encode(PROMPT_PREFIX, add_special_tokens=False)
+        SUFFIX_IDS = TOKENIZER.encode(PROMPT_SUFFIX, add_special_tokens=False)
         
-        # Modo inferência
-        MODEL.eval()
+        if INFERENCE_BACKEND != "vllm":
+            configure_generation()
+            compile_model()
+            build_prefix_cache()
         
-        # Desabilitar gradientes
-        for param in MODEL.parameters():
-            param.requires_grad = False
+        warmup_model()
+        start_batch_worker()
         
         load_time = time.time() - start_time
         MODEL_LOADED = True
@@ -129,11 +476,362 @@ def load_model():
         MODEL_LOADED = False
         return False
 
+# ============================================
+# BATCHING DINÂMICO
+# ============================================
+
+def _sampling_kwargs(temperature: float):
+    """Parâmetros de decodificação do HF: greedy (generation_config) por padrão, amostragem só com temperature > 0"""
+    if temperature > 0:
+        return {"do_sample": True, "temperature": temperature, "top_p": TOP_P}
+    return {}
+
+def _to_device(tensor: torch.Tensor) -> torch.Tensor:
+    """Copia para a GPU a partir de memória pinned, sem bloquear a thread"""
+    if DEVICE == "cuda":
+        # Cópia assíncrona no stream padrão: fica ordenada antes dos kernels do generate
+        return tensor.pin_memory().to(DEVICE, non_blocking=True)
+    return tensor
+
+def _static_batch_size(batch_size: int) -> int:
+    """Tamanho de lote efetivo: com CUDA graphs, lotes maiores que 1 são completados até BATCH_MAX_SIZE"""
+    if COMPILE_MODEL and batch_size > 1:
+        return BATCH_MAX_SIZE
+    return batch_size
+
+class _StopFillerRows(StoppingCriteria):
+    """Marca como concluídas, desde o primeiro passo, as linhas de preenchimento do lote"""
+    
+    def __init__(self, num_rows: int):
+        self.num_rows = num_rows
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        done[self.num_rows:] = True
+        return done
+
+def _static_cache(batch_size: int):
+    """Retorna o KV cache estático do tamanho de lote, alocado uma única vez e zerado a cada uso"""
+    cache = STATIC_CACHES.get(batch_size)
+    if cache is None:
+        # No máximo dois caches: lote unitário (streaming) e o lote maior mais recente
+        if batch_size > 1:
+            for size in [size for size in STATIC_CACHES if size > 1]:
+                del STATIC_CACHES[size]
+        cache = StaticCache(
+            config=MODEL.config,
+            max_batch_size=batch_size,
+            max_cache_len=STATIC_CACHE_LEN,
+            device=DEVICE,
+            dtype=MODEL.dtype
+        )
+        STATIC_CACHES[batch_size] = cache
+    else:
+        cache.reset()
+    return cache
+
+def _build_hf_inputs(rows: list):
+    """Monta tensores (e KV do prefixo, se ativo) para uma lista de input_ids"""
+    if PREFIX_KV is not None:
+        # Prefixo fixo no início de cada linha (posições do KV pré-computado);
+        # o padding fica entre o prefixo e os turnos, mascarado pelo attention_mask
+        prefix_len = len(PREFIX_IDS)
+        turns = TOKENIZER.pad(
+            {"input_ids": [input_ids[prefix_len:] for input_ids in rows]},
+            return_tensors="pt"
+        )
+        prefix = torch.tensor([PREFIX_IDS] * len(rows), dtype=turns["input_ids"].dtype)
+        inputs = {
+            "input_ids": _to_device(torch.cat([prefix, turns["input_ids"]], dim=1)),
+            "attention_mask": _to_device(torch.cat([torch.ones_like(prefix), turns["attention_mask"]], dim=1))
+        }
+        
+        # Cópia por requisição: o generate estende o cache in-place
+        past_key_values = copy.deepcopy(PREFIX_KV)
+        past_key_values.batch_repeat_interleave(len(rows))
+        return inputs, {"past_key_values": past_key_values}
+    
+    # Padding à esquerda para alinhar o início da geração
+    padded = TOKENIZER.pad({"input_ids": rows}, return_tensors="pt")
+    inputs = {
+        "input_ids": _to_device(padded["input_ids"]),
+        "attention_mask": _to_device(padded["attention_mask"])
+    }
+    return inputs, {}
+
+def _generate_hf_batch(batch: list):
+    """Geração em lote via Transformers; retorna [(texto da resposta, tokens gerados)]"""
+    _, max_tokens, temperature, _ = batch[0]
+    
+    rows = [input_ids for input_ids, _, _, _ in batch]
+    generate_kwargs = {}
+    if use_static_cache() and _static_batch_size(len(rows)) > len(rows):
+        # Lotes completados até BATCH_MAX_SIZE (repetindo a primeira linha) para reutilizar
+        # as mesmas formas dos CUDA graphs; as linhas extras terminam já no primeiro passo
+        rows += [rows[0]] * (_static_batch_size(len(rows)) - len(rows))
+        generate_kwargs["stopping_criteria"] = StoppingCriteriaList([_StopFillerRows(len(batch))])
+    inputs, cache_kwargs = _build_hf_inputs(rows)
+    
+    with GPU_LOCK, torch.inference_mode():
+        # Cache estático criado/zerado sob o lock: um único uso por vez
+        if use_static_cache():
+            cache_kwargs["past_key_values"] = _static_cache(len(rows))
+        outputs = MODEL.generate(
+            **inputs,
+            **cache_kwargs,
+            **_sampling_kwargs(temperature),
+            **generate_kwargs,
+            max_new_tokens=max_tokens,
+        )
+    
+    # Decodificar
+    logger.info("📖 Decodificando saída...")
+    input_length = inputs["input_ids"].shape[1]
+    results = []
+    for output in outputs[:len(batch)]:
+        # Decodificar apenas os tokens novos (o prompt não é re-decodificado)
+        new_tokens = output[input_length:]
+        code = TOKENIZER.decode(new_tokens, skip_special_tokens=True).strip()
+        
+        # Linhas que terminam antes das demais são completadas com padding
+        tokens_generated = int((new_tokens != TOKENIZER.pad_token_id).sum())
+        results.append((code, tokens_generated))
+    return results
+
+def _generate_vllm_batch(batch: list):
+    """Geração em lote via vLLM; retorna [(texto da resposta, tokens gerados)]"""
+    prompts = [{"prompt_token_ids": input_ids} for input_ids, _, _, _ in batch]
+    
+    # KV cache paginado: blocos de KV_BLOCK_SIZE alocados conforme a geração avança,
+    # sem reservar max_tokens de antemão
+    sampling_params = [
+        SamplingParams(temperature=temperature, top_p=TOP_P, max_tokens=max_tokens)
+        for _, max_tokens, temperature, _ in batch
+    ]
+    outputs = ENGINE.generate(
+        prompts,
+        sampling_params,
+        lora_request=LORA_REQUEST,
+        use_tqdm=False
+    )
+    
+    # vLLM já retorna apenas a continuação (sem o prompt), na ordem de entrada
+    results = []
+    for output in outputs:
+        completion = output.outputs[0]
+        results.append((completion.text.strip(), len(completion.token_ids)))
+    return results
+
+def _resolve(future: Future, result=None, error: Exception = None):
+    """Entrega resultado/erro, ignorando requisições que já desistiram (timeout)"""
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+def _run_batch(generate_fn, batch: list):
+    """Executa um lote e entrega o resultado (ou erro) a cada requisição"""
+    # Requisições que expiraram enquanto aguardavam na fila não ocupam a GPU
+    batch = [item for item in batch if not item[3].cancelled()]
+    if not batch:
+        return
+    
+    try:
+        results = generate_fn(batch)
+    except Exception as e:
+        for _, _, _, future in batch:
+            _resolve(future, error=e)
+        return
+    
+    for (_, _, _, future), result in zip(batch, results):
+        _resolve(future, result=result)
+
+def _batch_worker():
+    """Consome a fila e agrupa requisições concorrentes em uma única geração"""
+    while True:
+        batch = [REQUEST_QUEUE.get()]
+        
+        # Qualquer erro vai para as requisições do lote; a thread nunca morre
+        try:
+            # Aguardar outras requisições por até BATCH_WAIT_TIMEOUT_S
+            deadline = time.monotonic() + BATCH_WAIT_TIMEOUT_S
+            while len(batch) < BATCH_MAX_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(REQUEST_QUEUE.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            if INFERENCE_BACKEND == "vllm":
+                # vLLM aceita parâmetros de amostragem por prompt
+                _run_batch(_generate_vllm_batch, batch)
+            else:
+                # generate do HF usa uma única configuração por chamada
+                groups = {}
+                for item in batch:
+                    _, max_tokens, temperature, _ = item
+                    groups.setdefault((max_tokens, temperature), []).append(item)
+                for group in groups.values():
+                    _run_batch(_generate_hf_batch, group)
+        except Exception as e:
+            logger.error(f"❌ Erro no batch worker: {str(e)}")
+            logger.error(traceback.format_exc())
+            for _, _, _, future in batch:
+                _resolve(future, error=e)
+
+def start_batch_worker():
+    """Inicia a thread de batching (uma única vez)"""
+    global BATCH_WORKER
+    
+    if BATCH_WORKER is None:
+        BATCH_WORKER = threading.Thread(target=_batch_worker, name="batch-worker", daemon=True)
+        BATCH_WORKER.start()
+        logger.info(f"📦 Batching dinâmico ativo (até {BATCH_MAX_SIZE} req, janela {BATCH_WAIT_TIMEOUT_S * 1000:.0f}ms)")
+
+def submit_generation(input_ids: list, max_tokens: int, temperature: float):
+    """Enfileira uma geração e aguarda o resultado do lote"""
+    future = Future()
+    REQUEST_QUEUE.put((input_ids, max_tokens, temperature, future))
+    try:
+        return future.result(timeout=GENERATION_TIMEOUT_S)
+    except FutureTimeoutError:
+        future.cancel()
+        raise TimeoutError(f"Geração excedeu {GENERATION_TIMEOUT_S:.0f}s")
+
+# ============================================
+# STREAMING (SSE)
+# ============================================
+
+class _StopOnEvent(StoppingCriteria):
+    """Interrompe a geração quando o cliente desconecta"""
+    
+    def __init__(self, event: threading.Event):
+        self.event = event
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+def _sse(payload: Dict[str, Any]) -> str:
+    """Formata um evento Server-Sent Events"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def stream_code(input_ids: list, max_tokens: int, temperature: float):
+    """Gera código emitindo eventos SSE conforme os tokens são produzidos"""
+    inference_start = time.time()
+    
+    if INFERENCE_BACKEND == "vllm":
+        # LLM offline do vLLM não expõe streaming: envia a resposta inteira de uma vez
+        try:
+            code, tokens_generated = submit_generation(input_ids, max_tokens, temperature)
+        except Exception as e:
+            logger.error(f"❌ Erro na geração (stream): {str(e)}")
+            yield _sse({"success": False, "error": str(e)})
+            return
+        yield _sse({"token": code})
+    else:
+        inputs, cache_kwargs = _build_hf_inputs([input_ids])
+        streamer = TextIteratorStreamer(TOKENIZER, skip_prompt=True, skip_special_tokens=True)
+        stop_event = threading.Event()
+        result = {}
+        
+        def _run():
+            try:
+                with GPU_LOCK, torch.inference_mode():
+                    if use_static_cache():
+                        cache_kwargs["past_key_values"] = _static_cache(1)
+                    outputs = MODEL.generate(
+                        **inputs,
+                        **cache_kwargs,
+                        **_sampling_kwargs(temperature),
+                        max_new_tokens=max_tokens,
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop_event)]),
+                    )
+                result["tokens_generated"] = outputs.shape[1] - inputs["input_ids"].shape[1]
+            except Exception as e:
+                logger.error(f"❌ Erro na geração (stream): {str(e)}")
+                result["error"] = str(e)
+                streamer.end()
+        
+        thread = threading.Thread(target=_run, name="stream-generate", daemon=True)
+        thread.start()
+        
+        try:
+            for text in streamer:
+                if text:
+                    yield _sse({"token": text})
+        finally:
+            # Cliente desconectou (GeneratorExit) ou geração terminou: libera a GPU
+            stop_event.set()
+            thread.join()
+        
+        if "error" in result:
+            yield _sse({"success": False, "error": result["error"]})
+            return
+        tokens_generated = result["tokens_generated"]
+    
+    inference_time = (time.time() - inference_start) * 1000  # ms
+    logger.info(f"✅ Código gerado (stream): {tokens_generated} tokens em {inference_time:.0f}ms")
+    
+    yield _sse({
+        "success": True,
+        "done": True,
+        "tokens_generated": int(tokens_generated),
+        "inference_time_ms": round(inference_time, 2),
+        "gpu_memory": get_gpu_memory()
+    })
+
 # ============================================
 # GERAÇÃO DE CÓDIGO
 # ============================================
 
-def generate_code(messages: list = None, prompt: str = None, max_tokens: int = None, temperature: float = None) -> Dict[str, Any]:
+def build_input_ids(messages: list = None, prompt: str = None):
+    """
+    Tokeniza o histórico (ou prompt único) no formato de chat do Llama
+    
+    Mensagens mais antigas são descartadas até caber em MAX_PROMPT_TOKENS.
+    Retorna None se nem a mensagem mais recente couber.
+    """
+    if not messages:
+        # Retrocompatibilidade com prompt único
+        messages = [{"role": "user", "content": prompt or ""}]
+    
+    # Montar turnos no formato Llama (system e header do assistente já tokenizados)
+    turns = []
+    for msg in messages:
+        role = msg.get("role", "user")
+        content = msg.get("content", "")
+        turns.append(f"<|start_header_id|>{role}<|end_header_id|>\n\n{content}<|eot_id|>")
+    
+    # Tokenizar os turnos em lote (tokenizer rápido, em Rust)
+    turn_ids = TOKENIZER(turns, add_special_tokens=False)["input_ids"]
+    
+    # Manter os turnos mais recentes que cabem no limite
+    budget = MAX_PROMPT_TOKENS - len(PREFIX_IDS) - len(SUFFIX_IDS)
+    kept = []
+    for ids in reversed(turn_ids):
+        if len(ids) > budget:
+            break
+        kept.append(ids)
+        budget -= len(ids)
+    
+    if not kept:
+        return None
+    
+    # Concatenar com prefixo/sufixo fixos
+    input_ids = list(PREFIX_IDS)
+    for ids in reversed(kept):
+        input_ids.extend(ids)
+    input_ids.extend(SUFFIX_IDS)
+    return input_ids
+
+
+def generate_code(messages: list = None, prompt: str = None, max_tokens: int = None, temperature: float = None, input_ids: list = None) -> Dict[str, Any]:
     """
     Gera código Python a partir de um prompt ou histórico de mensagens
     
@@ -142,6 +840,7 @@ def generate_code(messages: list = None, prompt: str = None, max_tokens: int = N
         prompt: Instrução única (retrocompatibilidade)
         max_tokens: Máximo de tokens a gerar
         temperature: Controle de criatividade (0-1)
+        input_ids: Prompt já tokenizado (evita tokenizar novamente)
     
     Returns:
         Dict com código gerado e metadados
@@ -155,69 +854,34 @@ def generate_code(messages: list = None, prompt: str = None, max_tokens: int = N
       
     try:
         max_tokens = max_tokens or MAX_TOKENS
-        temperature = temperature or TEMPERATURE
+        temperature = TEMPERATURE if temperature is None else temperature
         
         # Construir prompt a partir de mensagens ou prompt único
         if messages:
             logger.info(f"📝 Gerando código com histórico de {len(messages)} mensagens...")
-            
-            # Montar prompt no formato Llama com histórico
-            full_prompt = "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\nYou are a helpful Python programming assistant. Write clear, correct, and well-commented code. Always provide working examples when appropriate.<|eot_id|>"
-            
-            for msg in messages:
-                role = msg.get("role", "user")
-                content = msg.get("content", "")
-                full_prompt += f"<|start_header_id|>{role}<|end_header_id|>\n\n{content}<|eot_id|>"
-            
-            # Adicionar header do assistente para a próxima resposta
-            full_prompt += "<|start_header_id|>assistant<|end_header_id|>\n\n"
         else:
-            # Retrocompatibilidade com prompt único
-            prompt_text = prompt or ""
-            logger.info(f"📝 Gerando código para: {prompt_text[:50]}...")
-            
-            full_prompt = f"""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
-
-You are a helpful Python programming assistant. Write clear, correct, and well-commented code. Always provide working examples when appropriate.<|eot_id|><|start_header_id|>user<|end_header_id|>
-
-{prompt_text}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
-
-"""
+            logger.info(f"📝 Gerando código para: {(prompt or '')[:50]}...")
         
-        # Tokenizar
-        logger.info("🔤 Tokenizando prompt...")
-        inputs = TOKENIZER(full_prompt, return_tensors="pt").to(DEVICE)
+        if input_ids is None:
+            logger.info("🔤 Tokenizando prompt...")
+            input_ids = build_input_ids(messages=messages, prompt=prompt)
+        
+        if input_ids is None:
+            return {
+                "success": False,
+                "error": f"Prompt muito longo (máx {MAX_PROMPT_TOKENS} tokens)",
+                "code": "",
+                "model_loaded": MODEL_LOADED
+            }
         
         # Gerar
         device_name = "GPU" if DEVICE == "cuda" else "CPU"
-        logger.info(f"⚡ Executando geração na {device_name}...")
+        logger.info(f"⚡ Executando geração na {device_name} ({INFERENCE_BACKEND})...")
         inference_start = time.time()
         
-        with torch.no_grad():
-            outputs = MODEL.generate(
-                **inputs,
-                max_new_tokens=max_tokens,
-                temperature=temperature,
-                top_p=TOP_P,
-                do_sample=True,
-                pad_token_id=TOKENIZER.eos_token_id,
-                eos_token_id=TOKENIZER.eos_token_id,
-            )
+        code, tokens_generated = submit_generation(input_ids, max_tokens, temperature)
         
         inference_time = (time.time() - inference_start) * 1000  # ms
-        
-        # Decodificar
-        logger.info("📖 Decodificando saída...")
-        full_response = TOKENIZER.decode(outputs[0], skip_special_tokens=True)
-        
-        # Extrair apenas a parte da resposta (pós assistant header)
-        if "assistant" in full_response:
-            code = full_response.split("assistant")[-1].strip()
-        else:
-            code = full_response
-        
-        input_length = inputs["input_ids"].shape[1]
-        tokens_generated = outputs[0].shape[0] - input_length
 
         logger.info(f"✅ Código gerado: {tokens_generated} tokens em {inference_time:.0f}ms")
         
@@ -251,43 +915,84 @@ def health():
         "status": "online",
         "model_loaded": MODEL_LOADED,
         "device": str(DEVICE),
-        "gpu_available": torch.cuda.is_available(),
-        "gpu_name": torch.cuda.get_device_name(0) if torch.cuda.is_available() else "N/A",
+        "gpu_available": CUDA_AVAILABLE,
+        "gpu_name": GPU_NAME,
         "gpu_memory": get_gpu_memory()
     })
 
+def parse_generate_request(data: Dict[str, Any]):
+    """Valida o corpo de /generate; retorna (parâmetros, mensagem de erro)"""
+    if not data:
+        return None, "Nenhum JSON recebido"
+    
+    # Suportar tanto 'messages' (novo) quanto 'prompt' (retrocompatibilidade)
+    messages = data.get('messages', [])
+    prompt = data.get('prompt', '').strip()
+    
+    if not messages and not prompt:
+        return None, "Nenhuma mensagem ou prompt fornecido"
+    
+    max_tokens = data.get('max_tokens', MAX_TOKENS)
+    temperature = data.get('temperature')
+    if temperature is None:
+        # Ausente ou null: usar o padrão do servidor (greedy)
+        temperature = TEMPERATURE
+    
+    # Validação
+    if isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1:
+        return None, "max_tokens deve ser um inteiro positivo"
+    
+    # Acima do limite do servidor: limitado a MAX_TOKENS (caches e AWQ dimensionados por ele)
+    max_tokens = min(max_tokens, MAX_TOKENS)
+    
+    if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or not 0 <= temperature <= 1:
+        return None, "Temperature deve estar entre 0 e 1"
+    
+    # Limitar número de mensagens (para evitar contexto muito grande)
+    if messages and len(messages) > 20:
+        messages = messages[-20:]  # Pegar apenas as 20 últimas
+    
+    return {
+        "messages": messages,
+        "prompt": prompt,
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }, None
+
 @app.route('/generate', methods=['POST'])
 def generate():
     """Endpoint para gerar código"""
     try:
-        data = request.get_json()
+        params, error = parse_generate_request(request.get_json())
         
-        if not data:
-            return jsonify({"error": "Nenhum JSON recebido"}), 400
+        if error:
+            return jsonify({"error": error}), 400
         
-        # Suportar tanto 'messages' (novo) quanto 'prompt' (retrocompatibilidade)
-        messages = data.get('messages', [])
-        prompt = data.get('prompt', '').strip()
+        messages = params["messages"]
+        prompt = params["prompt"]
+        max_tokens = params["max_tokens"]
+        temperature = params["temperature"]
         
-        if not messages and not prompt:
-            return jsonify({"error": "Nenhuma mensagem ou prompt fornecido"}), 400
+        if not MODEL_LOADED:
+            return jsonify({"success": False, "error": "Modelo não carregado", "code": ""}), 500
         
-        max_tokens = data.get('max_tokens', MAX_TOKENS)
-        temperature = data.get('temperature', TEMPERATURE)
-        
-        # Validação
-        if not 0 <= temperature <= 1:
-            return jsonify({"error": "Temperature deve estar entre 0 e 1"}), 400
+        # Limite em tokens (não em caracteres) antes de ocupar a GPU
+        input_ids = build_input_ids(messages=messages, prompt=prompt)
+        if input_ids is None:
+            return jsonify({"error": f"Prompt muito longo (máx {MAX_PROMPT_TOKENS} tokens)"}), 400
         
-        # Limitar número de mensagens (para evitar contexto muito grande)
-        if messages and len(messages) > 20:
-            messages = messages[-20:]  # Pegar apenas as 20 últimas
+        # Rejeitar sob sobrecarga em vez de arriscar OOM na GPU
+        if not GPU_SEMAPHORE.acquire(timeout=BUSY_TIMEOUT_S):
+            return jsonify({"error": "Servidor ocupado, tente novamente", "success": False}), 503
         
         # Gerar código
-        if messages:
-            result = generate_code(messages=messages, max_tokens=max_tokens, temperature=temperature)
-        else:
-            result = generate_code(prompt=prompt, max_tokens=max_tokens, temperature=temperature)
+        try:
+            if messages:
+                result = generate_code(messages=messages, max_tokens=max_tokens, temperature=temperature, input_ids=input_ids)
+            else:
+                result = generate_code(prompt=prompt, max_tokens=max_tokens, temperature=temperature, input_ids=input_ids)
+        finally:
+            GPU_SEMAPHORE.release()
         
         if result["success"]:
             return jsonify(result), 200
@@ -301,6 +1006,43 @@ def generate():
             "success": False
         }), 500
 
+@app.route('/generate/stream', methods=['POST'])
+def generate_stream():
+    """Endpoint para gerar código com streaming de tokens (SSE)"""
+    try:
+        params, error = parse_generate_request(request.get_json())
+        
+        if error:
+            return jsonify({"error": error}), 400
+        
+        if not MODEL_LOADED:
+            return jsonify({"success": False, "error": "Modelo não carregado"}), 500
+        
+        # Limite em tokens (não em caracteres) antes de ocupar a GPU
+        input_ids = build_input_ids(messages=params["messages"], prompt=params["prompt"])
+        if input_ids is None:
+            return jsonify({"error": f"Prompt muito longo (máx {MAX_PROMPT_TOKENS} tokens)"}), 400
+        
+        # Rejeitar sob sobrecarga em vez de arriscar OOM na GPU
+        if not GPU_SEMAPHORE.acquire(timeout=BUSY_TIMEOUT_S):
+            return jsonify({"error": "Servidor ocupado, tente novamente", "success": False}), 503
+        
+        response = Response(
+            stream_with_context(stream_code(input_ids, params["max_tokens"], params["temperature"])),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+        # Vaga liberada quando o stream termina ou o cliente desconecta
+        response.call_on_close(GPU_SEMAPHORE.release)
+        return response
+    
+    except Exception as e:
+        logger.error(f"❌ Erro no endpoint /generate/stream: {str(e)}")
+        return jsonify({
+            "error": str(e),
+            "success": False
+        }), 500
+
 @app.route('/clear-cache', methods=['POST'])
 def clear_cache():
     """Limpa memória GPU"""
@@ -313,18 +1055,17 @@ def clear_cache():
 @app.route('/stats', methods=['GET'])
 def stats():
     """Retorna estatísticas do servidor"""
-    cpu_percent = psutil.cpu_percent(interval=1)
     ram = psutil.virtual_memory()
     
     return jsonify({
         "model_loaded": MODEL_LOADED,
         "device": str(DEVICE),
         "gpu_memory": get_gpu_memory(),
-        "cpu_usage_percent": cpu_percent,
+        "cpu_usage_percent": CPU_PERCENT,
         "ram_usage_percent": ram.percent,
         "ram_available_gb": round(ram.available / 1e9, 2),
-        "cuda_available": torch.cuda.is_available(),
-        "torch_version": torch.__version__
+        "cuda_available": CUDA_AVAILABLE,
+        "torch_version": TORCH_VERSION
     })
 
 # ============================================
@@ -344,15 +1085,19 @@ if __name__ == '__main__':
         logger.error("❌ Falha ao carregar modelo!")
         exit(1)
     
+    start_cpu_monitor()
+    
     logger.info("✅ Servidor pronto!")
     logger.info("🚀 Escutando em http://localhost:5000")
     
     # Iniciar servidor
-    # Para desenvolvimento
-    app.run(host='127.0.0.1', port=5000, debug=False)
+    # Para desenvolvimento (uma thread por requisição, agrupadas pelo batch worker)
+    app.run(host='127.0.0.1', port=5000, debug=False, threaded=True)
     
-    # Para produção, usar Gunicorn:
-    # gunicorn -w 1 -b 127.0.0.1:5000 app:app --timeout 120
+    # Para produção, usar Gunicorn com threads (configuração em gunicorn.conf.py):
+    # gunicorn -c gunicorn.conf.py app:app
+    # (PYTORCH_CUDA_ALLOC_CONF=backend:cudaMallocAsync já é aplicado pelo app.py, exceto com
+    #  COMPILE_MODEL=true; exporte a variável antes do comando para sobrescrever)
     def generate_code(prompt: str, max_tokens: int = None, temperature: float = None) -> Dict[str, Any]:
       """
       Gera código Python a partir de um prompt
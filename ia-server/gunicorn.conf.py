@@ -0,0 +1,37 @@
+"""
+Configuração do Gunicorn para produção:
+    gunicorn -c gunicorn.conf.py app:app
+"""
+import os
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = "127.0.0.1:5000"
+
+# Um único processo mantém o modelo na GPU; as threads atendem requisições
+# concorrentes, que são agrupadas pelo batch worker do app
+workers = 1
+worker_class = "gthread"
+
+# Mesmos padrões do app.py; threads extras (além das vagas do semáforo) ficam livres
+# para /health, /stats e para responder 503 quando a GPU está ocupada
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', os.getenv('BATCH_MAX_SIZE', 8)))
+threads = MAX_CONCURRENT_REQUESTS + 4
+
+# O modelo é carregado no post_worker_init, antes do primeiro heartbeat do worker:
+# o timeout precisa cobrir o boot mais lento (download + merge do LoRA na primeira execução).
+# Com o checkpoint mesclado já em cache (MERGED_MODEL_PATH), o boot leva poucos minutos
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 1800))
+
+def post_worker_init(worker):
+    """Carrega o modelo no worker antes de aceitar requisições"""
+    from app import load_model, start_cpu_monitor
+
+    if not load_model():
+        worker.log.error("❌ Falha ao carregar modelo!")
+        sys.exit(3)  # WORKER_BOOT_ERROR: encerra o Gunicorn em vez de reiniciar o worker
+
+    start_cpu_monitor()
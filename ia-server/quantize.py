@@ -0,0 +1,73 @@
+"""
+Conversão offline: mescla os adapters LoRA no Llama-3.1-8B (fp16) e
+quantiza o resultado para AWQ INT4 (group size 128).
+
+Uso:
+    python quantize.py --output ./merged-awq
+
+Depois, aponte QUANTIZED_MODEL_PATH=./merged-awq no .env.
+"""
+import argparse
+import logging
+import os
+import tempfile
+
+import torch
+from awq import AutoAWQForCausalLM
+from dotenv import load_dotenv
+from peft import PeftModel
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# O checkpoint bnb-4bit usado em runtime não pode ser requantizado; partimos do fp16
+FP16_BASE_MODEL = os.getenv('FP16_BASE_MODEL', 'unsloth/Meta-Llama-3.1-8B-Instruct')
+ADAPTER_PATH = os.getenv('ADAPTER_PATH', './adapters')
+
+QUANT_CONFIG = {
+    "zero_point": True,
+    "q_group_size": 128,
+    "w_bit": 4,
+    "version": "GEMM"
+}
+
+def merge_lora(output_dir: str):
+    """Carrega base fp16 + LoRA, mescla os pesos e salva em output_dir"""
+    logger.info(f"📦 Carregando modelo base {FP16_BASE_MODEL} (fp16)...")
+    model = AutoModelForCausalLM.from_pretrained(
+        FP16_BASE_MODEL,
+        torch_dtype=torch.float16,
+        device_map="cpu"
+    )
+
+    logger.info(f"🎯 Mesclando LoRA adapters de {ADAPTER_PATH}...")
+    model = PeftModel.from_pretrained(model, ADAPTER_PATH)
+    model = model.merge_and_unload()
+
+    model.save_pretrained(output_dir, safe_serialization=True)
+    AutoTokenizer.from_pretrained(FP16_BASE_MODEL).save_pretrained(output_dir)
+
+def quantize(merged_dir: str, output_dir: str):
+    """Quantiza o modelo mesclado para AWQ INT4 e salva em output_dir"""
+    logger.info("⚙️  Quantizando para AWQ INT4 (g128)...")
+    model = AutoAWQForCausalLM.from_pretrained(merged_dir, safetensors=True)
+    tokenizer = AutoTokenizer.from_pretrained(merged_dir)
+
+    model.quantize(tokenizer, quant_config=QUANT_CONFIG)
+
+    model.save_quantized(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    logger.info(f"✅ Checkpoint AWQ salvo em {output_dir}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mescla LoRA e quantiza para AWQ INT4")
+    parser.add_argument('--output', default='./merged-awq', help="Diretório do checkpoint AWQ")
+    args = parser.parse_args()
+
+    # Checkpoint fp16 intermediário (~16 GB) ao lado da saída, não no /tmp (muitas vezes tmpfs)
+    with tempfile.TemporaryDirectory(prefix=".merged-", dir=os.path.dirname(os.path.abspath(args.output))) as merged_dir:
+        merge_lora(merged_dir)
+        quantize(merged_dir, args.output)
@@ -103,7 +103,8 @@ export async function POST(request: NextRequest) {
 
     const requestBody: GenerateRequest = {
       max_tokens: max_tokens || 512,
-      temperature: temperature || 0.7,
+      // Sem temperature explícita, o IA Server usa decodificação greedy
+      temperature,
     };
 
     if (messages) {
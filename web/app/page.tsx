@@ -94,7 +94,6 @@ export default function Home() {
         body: JSON.stringify({
           messages: recentHistory,
           max_tokens: 512,
-          temperature: 0.7,
         }),
       });
 